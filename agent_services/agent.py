@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import os
 from tenacity import AsyncRetrying, retry_if_exception_type, wait_exponential, stop_after_attempt
@@ -6,12 +7,37 @@ from cosmos_utils.chat_history_models import (
     CitationRangeFile,
     ConversationChatResponse,
     MessageRole,
+    ThreadCompaction,
     TokenUsage,
     datetime_factory,
 )
 from azure.core.exceptions import HttpResponseError
 from azure.identity import ClientSecretCredential
 from azure.ai.projects.aio import AIProjectClient
+from azure.ai.agents.models import (
+    ListSortOrder,
+    RunStatus,
+    ThreadMessageOptions,
+    TruncationObject,
+    TruncationStrategy,
+)
+from agent_services.deadline import Deadline, DeadlineExceeded
+
+# Same interval create_and_process uses to poll a run
+RUN_POLL_INTERVAL_SECONDS = 1.0
+RETRY_MIN_WAIT_SECONDS = 6
+RETRY_MAX_WAIT_SECONDS = 10
+# Shortest run worth starting; below this, a new attempt would only be created to be cancelled
+MIN_RUN_SECONDS = 10
+ACTIVE_RUN_STATUSES = (RunStatus.QUEUED, RunStatus.IN_PROGRESS, RunStatus.REQUIRES_ACTION)
+
+# Thread compaction: 'none', 'truncate' (run only on the last messages) or 'rollover' (new thread with a summary)
+THREAD_COMPACTION_STRATEGY = os.getenv("THREAD_COMPACTION_STRATEGY", "none")
+THREAD_COMPACTION_MAX_PROMPT_TOKENS = int(os.getenv("THREAD_COMPACTION_MAX_PROMPT_TOKENS", "24000"))
+THREAD_COMPACTION_MAX_TURNS = int(os.getenv("THREAD_COMPACTION_MAX_TURNS", "8"))
+THREAD_COMPACTION_LAST_MESSAGES = int(os.getenv("THREAD_COMPACTION_LAST_MESSAGES", "4"))
+SUMMARY_TURNS = 4
+SUMMARY_ANSWER_CHARS = 600
 
 
 class RateLimitException(Exception):
@@ -25,18 +51,22 @@ class AgentService:
     """
 
     _thread = None
+    _agent = None
+    _truncation_strategy = None
+    compaction: ThreadCompaction | None = None
     _agent_client = None
     _project_client = None
     _agent_id = None
 
-    def __init__(self, thread_id: str | None = None, agent_id: str | None = None):
+    def __init__(self, thread_id: str | None = None, agent_id: str | None = None, deadline: Deadline | None = None):
         self._agent_id = agent_id
         self._thread_id = thread_id
+        self._deadline = deadline
 
         if not self._agent_id:
             raise ValueError("Agent ID is not set")
 
-    async def _initialize_client(self):
+    async def initialize_client(self):
         """Initialize the async agent client."""
         if not self._project_client:
             try:
@@ -49,20 +79,80 @@ class AgentService:
                     credential=credentials,
                     endpoint=os.environ.get("AI_PROJECT_ENDPOINT")
                 )
-
-                # Get the agent to verify it exists
-                agent = await self._project_client.agents.get_agent(self._agent_id)
-                if not agent:
-                    logging.error(f"Agent with ID {self._agent_id} not found.")
-                    raise ValueError(f"Agent with ID {self._agent_id} not found.")
-
                 self._agent_client = self._project_client.agents
                 logging.debug("Agent client initialized successfully")
             except Exception as e:
-                logging.error(f"Error creating agent client: {e}")
+                logging.error("Error creating agent client: %s", e)
                 raise e
 
-    async def _retryable_call_to_foundry(self, agent_id: str = None):
+    async def get_agent(self):
+        """Retrieve the agent to verify it exists. Independent of the thread, so both can run concurrently."""
+        if self._agent is None:
+            assert self._agent_client
+            try:
+                agent = await self._agent_client.get_agent(self._agent_id)
+            except Exception as e:
+                logging.error("Error retrieving agent: %s", e)
+                raise Exception(f"Error retrieving agent: {e}")
+            if not agent:
+                logging.error("Agent with ID %s not found.", self._agent_id)
+                raise ValueError(f"Agent with ID {self._agent_id} not found.")
+            self._agent = agent
+        return self._agent
+
+    async def prepare(self):
+        """Initialize the client, then look up the agent and get or create the thread concurrently."""
+        await self.initialize_client()
+        await asyncio.gather(self.get_agent(), self.create_get_thread())
+
+    def _check_deadline(self, stage: str, reserve: float = 0.0):
+        if self._deadline:
+            self._deadline.check(stage, reserve)
+
+    def _stop_at_deadline(self, retry_state) -> bool:
+        """
+        Tenacity stop condition: give up, with `DeadlineExceeded`, when the budget cannot cover
+        the longest retry wait plus a minimal run.
+        """
+        self._check_deadline("agent_retry", reserve=RETRY_MAX_WAIT_SECONDS + MIN_RUN_SECONDS)
+        return False
+
+    async def _cancel_run(self, run):
+        try:
+            await self._agent_client.runs.cancel(thread_id=self._thread.id, run_id=run.id)
+            logging.warning("Run %s cancelled for thread %s", run.id, self._thread.id)
+        except Exception as e:
+            logging.error("Error cancelling run %s for thread %s: %s", run.id, self._thread.id, e)
+
+    async def _create_and_process_run(self, agent_id: str):
+        """
+        Equivalent of `runs.create_and_process` that checks the deadline between polls
+        and cancels the run when the deadline is exceeded or the request is cancelled.
+        """
+        run = await self._agent_client.runs.create(
+            thread_id=self._thread.id,
+            agent_id=agent_id,
+            truncation_strategy=self._truncation_strategy,
+        )
+        try:
+            while run.status in ACTIVE_RUN_STATUSES:
+                self._check_deadline("agent_run")
+                if run.status == RunStatus.REQUIRES_ACTION:
+                    # No client-side tools are registered, create_and_process cancels in this case too
+                    logging.warning("Run %s requires action but no toolset is available, cancelling", run.id)
+                    await self._cancel_run(run)
+                sleep = RUN_POLL_INTERVAL_SECONDS
+                if self._deadline:
+                    sleep = self._deadline.timeout(cap=sleep)
+                await asyncio.sleep(sleep)
+                run = await self._agent_client.runs.get(thread_id=self._thread.id, run_id=run.id)
+        except (DeadlineExceeded, asyncio.CancelledError):
+            # Nobody will receive the answer, stop spending tokens on it
+            await self._cancel_run(run)
+            raise
+        return run
+
+    async def _retryable_call_to_foundry(self, agent_id: str = None, max_attempts: int = 10):
         """
         Retryable function that retrieves the last message from the agent.
         """
@@ -83,23 +173,28 @@ class AgentService:
 
         async for attempt in AsyncRetrying(
             retry=retry_if_exception_type((RateLimitException, HttpResponseError, ValueError)),
-            wait=wait_exponential(multiplier=1, min=6, max=10),
-            stop=stop_after_attempt(10)
+            wait=wait_exponential(multiplier=1, min=RETRY_MIN_WAIT_SECONDS, max=RETRY_MAX_WAIT_SECONDS),
+            stop=stop_after_attempt(max_attempts) | self._stop_at_deadline
         ):
             with attempt:
                 retries = attempt.retry_state.attempt_number - 1
                 try:
-                    agent_run = await self._agent_client.runs.create_and_process(
-                        thread_id=self._thread.id,
-                        agent_id=agent_id
-                    )
+                    agent_run = await self._create_and_process_run(agent_id)
                 except HttpResponseError as e:
-                    logging.error(f"Error creating agent run for thread {self._thread.id}: {e}")
+                    logging.error("Error creating agent run for thread %s: %s", self._thread.id, e)
                     raise e
 
-                token_usage.total_tokens += agent_run.usage.total_tokens
-                token_usage.prompt_tokens += agent_run.usage.prompt_tokens
-                token_usage.completion_tokens += agent_run.usage.completion_tokens
+                if agent_run.usage:
+                    token_usage.total_tokens += agent_run.usage.total_tokens
+                    token_usage.prompt_tokens += agent_run.usage.prompt_tokens
+                    token_usage.completion_tokens += agent_run.usage.completion_tokens
+
+                if agent_run.status != RunStatus.COMPLETED:
+                    # Failed, cancelled or expired: the last agent message would be a previous turn's answer
+                    logging.warning(
+                        "Run %s for thread %s ended with status %s", agent_run.id, self._thread.id, agent_run.status
+                    )
+                    raise RateLimitException(f"Run {agent_run.id} ended with status {agent_run.status}, retrying...")
 
                 try:
                     message_res = await self._agent_client.messages.get_last_message_by_role(
@@ -108,23 +203,29 @@ class AgentService:
                     )
 
                     if not message_res or message_res.status == "failed":
-                        logging.warning(f"No response from agent or message failed for thread {self._thread.id}")
+                        logging.warning("No response from agent or message failed for thread %s", self._thread.id)
                         raise RateLimitException("Rate limit reached or message failed, retrying...")
                     if message_res.agent_id != agent_id:
                         logging.warning(
-                            f"Agent mismatch. {self._thread.id}: expected {agent_id}, "
-                            f"got {message_res.agent_id}"
+                            "Agent mismatch. %s: expected %s, got %s",
+                            self._thread.id, agent_id, message_res.agent_id
                         )
                         raise ValueError(f"Agent ID mismatch: expected {agent_id}, got {message_res.agent_id}")
+                    if message_res.run_id != agent_run.id:
+                        logging.warning(
+                            "Stale message for thread %s: expected run %s, got %s",
+                            self._thread.id, agent_run.id, message_res.run_id
+                        )
+                        raise ValueError(f"Last message belongs to run {message_res.run_id}, not {agent_run.id}")
 
                     # Success - return the result
                     return token_usage, message_res, retries
                 except HttpResponseError as e:
                     if hasattr(e, 'status_code') and e.status_code == 429:  # Rate limit error
-                        logging.warning(f"Rate limit error for thread {self._thread.id}: {e}")
+                        logging.warning("Rate limit error for thread %s: %s", self._thread.id, e)
                         raise RateLimitException(f"Rate limit reached: {e}")
                     else:
-                        logging.error(f"HTTP error retrieving last message for thread {self._thread.id}: {e}")
+                        logging.error("HTTP error retrieving last message for thread %s: %s", self._thread.id, e)
                         raise e
 
         # This should never be reached due to stop_after_attempt, but just in case
@@ -134,84 +235,179 @@ class AgentService:
         """Create a new thread or retrieve one for the agent."""
         try:
             assert self._agent_client
+            if self._thread:
+                return
             if self._thread_id:
                 self._thread = await self._agent_client.threads.get(self._thread_id)
-                logging.debug(f"Using existing thread ID: {self._thread.id}")
+                logging.debug("Using existing thread ID: %s", self._thread.id)
+                if THREAD_COMPACTION_STRATEGY in ("truncate", "rollover"):
+                    await self._compact_thread(THREAD_COMPACTION_STRATEGY)
             elif not self._thread and not self._thread_id:
                 self._thread = await self._agent_client.threads.create()
-                logging.debug(f"Thread created with ID: {self._thread.id}")
+                logging.debug("Thread created with ID: %s", self._thread.id)
 
         except HttpResponseError as e:
-            logging.error(f"Error creating or getting thread: {e}")
+            logging.error("Error creating or getting thread: %s", e)
             raise e
 
-    async def invoke(self, input: str | None):
+    async def _thread_size(self) -> tuple[int | None, int]:
+        """Prompt tokens of the latest run and number of user messages (capped) on the current thread."""
+        prompt_tokens = None
+        runs = self._agent_client.runs.list(thread_id=self._thread.id, limit=1, order=ListSortOrder.DESCENDING)
+        async for run in runs:
+            if run.usage:
+                prompt_tokens = run.usage.prompt_tokens
+            break
+
+        # Retried or routed runs answer the same question, so turns are counted on the user messages
+        turns = 0
+        messages = self._agent_client.messages.list(
+            thread_id=self._thread.id,
+            limit=(THREAD_COMPACTION_MAX_TURNS + 1) * 2,
+            order=ListSortOrder.DESCENDING,
+        )
+        async for message in messages:
+            if message.role == MessageRole.USER:
+                turns += 1
+                if turns > THREAD_COMPACTION_MAX_TURNS:
+                    break
+        return prompt_tokens, turns
+
+    async def _summarize_thread(self) -> str:
+        """Compact summary of the latest questions and answers, without their context blocks."""
+        entries = []
+        messages = self._agent_client.messages.list(
+            thread_id=self._thread.id,
+            limit=SUMMARY_TURNS * 2,
+            order=ListSortOrder.DESCENDING,
+        )
+        async for message in messages:
+            if not message.text_messages:
+                continue
+            text = message.text_messages[0].text.value
+            if message.role == MessageRole.USER:
+                question = text.split("\n\nContexto:\n", 1)[0].removeprefix("Pregunta:\n")
+                entries.append(f"Pregunta: {question.strip()}")
+            else:
+                answer = text.strip()
+                if len(answer) > SUMMARY_ANSWER_CHARS:
+                    answer = answer[:SUMMARY_ANSWER_CHARS] + "..."
+                entries.append(f"Respuesta: {answer}")
+            if len(entries) >= SUMMARY_TURNS * 2:
+                break
+        return "Resumen de la conversacion anterior:\n\n" + "\n\n".join(reversed(entries))
+
+    async def _compact_thread(self, strategy: str):
+        """
+        Cap the prompt of long threads.
+        'truncate' runs the agent on the last messages only; 'rollover' moves the conversation
+        to a new thread seeded with a summary, the new message then carries the latest context.
+        """
+        prompt_tokens, turns = await self._thread_size()
+        if (prompt_tokens or 0) < THREAD_COMPACTION_MAX_PROMPT_TOKENS and turns < THREAD_COMPACTION_MAX_TURNS:
+            return
+
+        previous_thread_id = None
+        if strategy == "truncate":
+            self._truncation_strategy = TruncationObject(
+                type=TruncationStrategy.LAST_MESSAGES,
+                last_messages=THREAD_COMPACTION_LAST_MESSAGES,
+            )
+        else:
+            summary = await self._summarize_thread()
+            previous_thread_id = self._thread.id
+            self._thread = await self._agent_client.threads.create(
+                messages=[ThreadMessageOptions(role=MessageRole.USER, content=summary)]
+            )
+        logging.info(
+            "Thread %s compacted with '%s' (%s prompt tokens, %s turns), now on %s",
+            previous_thread_id or self._thread.id, strategy, prompt_tokens, turns, self._thread.id
+        )
+        self.compaction = ThreadCompaction(
+            strategy=strategy,
+            previous_session_id=previous_thread_id,
+            prompt_tokens=prompt_tokens,
+            turns=turns,
+            datetime=datetime_factory(),
+        )
+
+    async def invoke(self, input: str | None, agent_id: str | None = None, max_attempts: int = 10):
         """ Function to get response from the agent."""
         try:
-            retries = 0
-
-            # Initialize the client first
-            await self._initialize_client()
-
-            assert self._agent_client is not None
-            assert self._agent_id is not None
-            await self.create_get_thread()
-            assert self._thread is not None
-            token_usage = []
-
             if input is None:
                 raise ValueError("Input cannot be None")
 
-            try:
-                await self._agent_client.get_agent(self._agent_id)
-            except Exception as e:
-                logging.error(f"Error retrieving agent: {e}")
-                raise Exception(f"Error retrieving agent: {e}")
+            # No-op when the request pipeline already ran these stages
+            if self._agent is None or self._thread is None:
+                await self.prepare()
 
-            try:
-                await self._agent_client.messages.create(
-                    thread_id=self._thread.id,
-                    role=MessageRole.USER,
-                    content=input,
-                )
-            except HttpResponseError as e:
-                logging.error(f"Error sending message for thread {self._thread.id}: {e}")
-                raise e
+            await self.send_message(input)
+            return await self.run(agent_id, max_attempts)
+        except Exception as e:
+            logging.error("Error getting agent response: %s", e)
+            raise e
 
-            token_usage_response, message_res, retries_answer = await self._retryable_call_to_foundry(self._agent_id)
-            retries += retries_answer
-
-            token_usage += [token_usage_response] if token_usage_response else []
-
-            citations = None
-            if message_res.text_messages[0].text.annotations:
-                citations = [Citation(
-                    type=citation.type or None,
-                    position_in_response=citation.text or None,
-                    citation_range_in_file=CitationRangeFile(
-                        start=citation.start_index or 0,
-                        end=citation.end_index or 0
-                    ) if citation.start_index is not None and citation.end_index is not None else None,
-                    citationTitle=None,
-                    citationUrl=citation.file_citation.file_id,
-                    abstract=None
-                ) for citation in message_res.text_messages[0].text.annotations]
-
-            response = ConversationChatResponse(
-                task_id=message_res.run_id,
-                task_status=message_res.status or "completed",
-                agent_id=message_res.agent_id,
-                content=message_res.text_messages[0].text.value,
-                citations=citations,
-                retries=retries,
-                datetime=datetime_factory(),
-            )
+    async def send_message(self, input: str):
+        """Add the user message to the thread."""
+        assert self._agent_client is not None
+        assert self._thread is not None
 
-            return response, token_usage, self._thread.id
-        except Exception as e:
-            logging.error(f"Error getting agent response: {e}")
+        self._check_deadline("messages_create")
+        try:
+            await self._agent_client.messages.create(
+                thread_id=self._thread.id,
+                role=MessageRole.USER,
+                content=input,
+            )
+        except HttpResponseError as e:
+            logging.error("Error sending message for thread %s: %s", self._thread.id, e)
             raise e
 
+    async def run(self, agent_id: str | None = None, max_attempts: int = 10):
+        """
+        Run an agent on the thread and build the response from its last message.
+        Defaults to the service agent; another agent can answer the same message, e.g. a routed one.
+        """
+        agent_id = agent_id or self._agent_id
+        assert self._agent_client is not None
+        assert agent_id is not None
+        assert self._thread is not None
+        retries = 0
+        token_usage = []
+
+        token_usage_response, message_res, retries_answer = await self._retryable_call_to_foundry(
+            agent_id, max_attempts
+        )
+        retries += retries_answer
+
+        token_usage += [token_usage_response] if token_usage_response else []
+
+        citations = None
+        if message_res.text_messages[0].text.annotations:
+            citations = [Citation(
+                type=citation.type or None,
+                position_in_response=citation.text or None,
+                citation_range_in_file=CitationRangeFile(
+                    start=citation.start_index or 0,
+                    end=citation.end_index or 0
+                ) if citation.start_index is not None and citation.end_index is not None else None,
+                citationTitle=None,
+                citationUrl=citation.file_citation.file_id,
+                abstract=None
+            ) for citation in message_res.text_messages[0].text.annotations]
+
+        response = ConversationChatResponse(
+            task_id=message_res.run_id,
+            task_status=message_res.status or "completed",
+            agent_id=message_res.agent_id,
+            content=message_res.text_messages[0].text.value,
+            citations=citations,
+            retries=retries,
+            datetime=datetime_factory(),
+        )
+
+        return response, token_usage, self._thread.id
+
     async def close(self):
         """Close the agent client."""
         if self._project_client:
@@ -0,0 +1,63 @@
+import os
+import time
+
+# Budget of a request, kept below the Functions host / HTTP front-end timeout
+DEFAULT_REQUEST_DEADLINE_SECONDS = 200.0
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a stage of the request runs out of budget."""
+
+    def __init__(self, stage: str, elapsed_ms: float, budget_ms: float):
+        self.stage = stage
+        self.elapsed_ms = elapsed_ms
+        self.budget_ms = budget_ms
+        super().__init__(f"Deadline exceeded at stage '{stage}' after {elapsed_ms:.0f} ms (budget {budget_ms:.0f} ms)")
+
+    def to_dict(self) -> dict:
+        return {
+            "error": "deadline_exceeded",
+            "stage": self.stage,
+            "elapsed_ms": round(self.elapsed_ms),
+            "budget_ms": round(self.budget_ms),
+        }
+
+
+class Deadline:
+    """
+    Per-request time budget, measured on the monotonic clock.
+    Created once in the HTTP trigger and passed down to every stage.
+    """
+
+    def __init__(self, budget_seconds: float):
+        self._budget = budget_seconds
+        self._start = time.monotonic()
+        self._expires = self._start + budget_seconds
+
+    @classmethod
+    def from_env(cls) -> "Deadline":
+        return cls(float(os.getenv("REQUEST_DEADLINE_SECONDS", DEFAULT_REQUEST_DEADLINE_SECONDS)))
+
+    def remaining(self) -> float:
+        """Seconds left, never negative."""
+        return max(self._expires - time.monotonic(), 0.0)
+
+    def elapsed_ms(self) -> float:
+        return (time.monotonic() - self._start) * 1000
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def check(self, stage: str, reserve: float = 0.0) -> None:
+        """Raise `DeadlineExceeded` unless more than `reserve` seconds are left."""
+        if self.remaining() <= reserve:
+            raise self.exceeded(stage)
+
+    def exceeded(self, stage: str) -> DeadlineExceeded:
+        return DeadlineExceeded(stage, self.elapsed_ms(), self._budget * 1000)
+
+    def timeout(self, cap: float | None = None) -> float:
+        """Timeout for a blocking call: the remaining budget, optionally capped."""
+        remaining = self.remaining()
+        return min(remaining, cap) if cap is not None else remaining
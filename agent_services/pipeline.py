@@ -0,0 +1,119 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+from agent_services.deadline import Deadline
+
+
+@dataclass
+class StageTiming:
+    """Start and end of a stage, in milliseconds since the graph started."""
+    start_ms: float
+    end_ms: float
+
+    @property
+    def duration_ms(self) -> float:
+        return self.end_ms - self.start_ms
+
+
+StageFunc = Callable[[Dict[str, Any]], Awaitable[Any]]
+
+
+class StageGraph:
+    """
+    Small dependency graph of async stages.
+    Every stage starts as soon as its dependencies are done, independent stages run concurrently.
+    Each stage function receives a dict with the results of its dependencies.
+    """
+
+    def __init__(self):
+        self._stages: Dict[str, Tuple[StageFunc, Tuple[str, ...]]] = {}
+        self.timings: Dict[str, StageTiming] = {}
+        self.cancelled: List[str] = []
+        self.results: Dict[str, Any] = {}
+
+    def add(self, name: str, func: StageFunc, deps: Tuple[str, ...] | List[str] = ()) -> "StageGraph":
+        """Register a stage. Dependencies must be registered first, which keeps the graph acyclic."""
+        if name in self._stages:
+            raise ValueError(f"Stage {name} is already registered")
+        missing = [dep for dep in deps if dep not in self._stages]
+        if missing:
+            raise ValueError(f"Stage {name} depends on unknown stages: {missing}")
+        self._stages[name] = (func, tuple(deps))
+        return self
+
+    async def run(self, deadline: Deadline | None = None) -> Dict[str, Any]:
+        """
+        Run every stage. The first failure cancels the stages still running and is re-raised.
+        With a deadline, each stage checks the remaining budget before starting, and stages still
+        running when it expires are cancelled and `DeadlineExceeded` is raised.
+        Only stages that finished, successfully or not, get a timing; cancelled ones are listed apart.
+        """
+        origin = time.perf_counter()
+        tasks: Dict[str, asyncio.Task] = {}
+        started: Dict[str, float] = {}
+
+        async def run_stage(name: str, func: StageFunc, deps: Tuple[str, ...]):
+            if deps:
+                await asyncio.gather(*(tasks[dep] for dep in deps))
+            inputs = {dep: tasks[dep].result() for dep in deps}
+            if deadline:
+                deadline.check(name)
+            start = started[name] = (time.perf_counter() - origin) * 1000
+            try:
+                return await func(inputs)
+            except asyncio.CancelledError:
+                self.cancelled.append(name)
+                raise
+            finally:
+                if name not in self.cancelled:
+                    self.timings[name] = StageTiming(start, (time.perf_counter() - origin) * 1000)
+
+        for name, (func, deps) in self._stages.items():
+            tasks[name] = asyncio.create_task(run_stage(name, func, deps), name=name)
+
+        done, pending = await asyncio.wait(
+            tasks.values(),
+            timeout=deadline.remaining() if deadline else None,
+            return_when=asyncio.FIRST_EXCEPTION,
+        )
+        failed = [task for task in done if not task.cancelled() and task.exception() is not None]
+        if pending:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        if not failed and pending:
+            # Name the stages that were running, not the ones still waiting on them
+            running = [task.get_name() for task in pending if task.get_name() in started]
+            stages = ",".join(running or [task.get_name() for task in pending])
+            raise deadline.exceeded(stages)
+        if failed:
+            # Report the stage that failed first, not the dependants that failed because of it
+            first = min(failed, key=lambda t: self.timings.get(t.get_name(), StageTiming(0, float("inf"))).end_ms)
+            raise first.exception()
+
+        self.results = {name: task.result() for name, task in tasks.items()}
+        return self.results
+
+    def critical_path(self) -> List[str]:
+        """Chain of stages that determined the total duration, from first to last."""
+        if not self.timings:
+            return []
+        path = []
+        name = max(self.timings, key=lambda n: self.timings[n].end_ms)
+        while name is not None:
+            path.append(name)
+            deps = [dep for dep in self._stages[name][1] if dep in self.timings]
+            name = max(deps, key=lambda n: self.timings[n].end_ms) if deps else None
+        return list(reversed(path))
+
+    def summary(self) -> Dict[str, Any]:
+        """Stage durations and the critical path, ready to attach to the request log."""
+        summary = {
+            "stages_ms": {name: round(timing.duration_ms) for name, timing in self.timings.items()},
+            "critical_path": self.critical_path(),
+        }
+        if self.cancelled:
+            summary["cancelled"] = list(self.cancelled)
+        return summary
@@ -0,0 +1,117 @@
+import json
+import logging
+import os
+import re
+import unicodedata
+
+from cosmos_utils.chat_history_models import AgentRoute
+from agent_services.agent import AgentService
+from agent_services.deadline import DeadlineExceeded
+
+# Marker the search context puts in front of every table
+TABLE_MARKER = "Titulo de la tabla:"
+
+# Attempts given to a routed agent before falling back to the default one
+ROUTED_MAX_ATTEMPTS = 3
+
+COMPARISON_PATTERN = re.compile(
+    r"\b(compar\w*|vs|versus|diferencia\w*|variacion\w*|respecto|frente a|entre|aument\w*|disminu\w*|"
+    r"mayor|menor|cambio\w*)\b"
+)
+ANALYSIS_PATTERN = re.compile(
+    r"\b(por que|porque|analiz\w*|analisis|explica\w*|tendencia\w*|causa\w*|recomien\w*|evalu\w*|"
+    r"impacto\w*|resum\w*|proyecc\w*|riesgo\w*)\b"
+)
+LOOKUP_MAX_WORDS = 25
+
+
+def _normalize(text: str) -> str:
+    """Lowercase and strip accents, so 'variación' and 'variacion' match the same pattern."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+def classify_question(question: str, context: str | None = None) -> tuple[str, int]:
+    """
+    Classify a question locally as 'lookup', 'comparison' or 'analysis'.
+    Returns the class and the number of tables in the context.
+    """
+    tables = (context or "").count(TABLE_MARKER)
+    normalized = _normalize(question)
+
+    if ANALYSIS_PATTERN.search(normalized) or tables > 3 or len(normalized.split()) > LOOKUP_MAX_WORDS * 2:
+        return "analysis", tables
+    if COMPARISON_PATTERN.search(normalized) or tables > 1 or len(normalized.split()) > LOOKUP_MAX_WORDS:
+        return "comparison", tables
+    return "lookup", tables
+
+
+def load_routes() -> dict[str, str]:
+    """
+    Agent per question class, from `AGENT_ROUTES`, e.g. '{"lookup": "asst_small"}'.
+    Classes without a route go to the agent requested by the caller.
+    """
+    raw = os.environ.get("AGENT_ROUTES")
+    if not raw:
+        return {}
+    try:
+        routes = json.loads(raw)
+    except json.JSONDecodeError as e:
+        logging.error("Invalid AGENT_ROUTES, routing disabled: %s", e)
+        return {}
+    if not isinstance(routes, dict):
+        logging.error("Invalid AGENT_ROUTES, routing disabled: expected a JSON object, got %s", type(routes).__name__)
+        return {}
+    return {key: value for key, value in routes.items() if isinstance(value, str) and value}
+
+
+# Parsed once per worker, like the other settings read from the environment
+AGENT_ROUTES = load_routes()
+
+
+def choose_route(question: str, context: str | None, default_agent_id: str) -> AgentRoute:
+    question_class, tables = classify_question(question, context)
+    agent_id = AGENT_ROUTES.get(question_class, default_agent_id)
+    return AgentRoute(
+        question_class=question_class,
+        tables=tables,
+        agent_id=agent_id,
+        default_agent_id=default_agent_id,
+    )
+
+
+async def invoke_routed(agent_service: AgentService, input: str, route: AgentRoute):
+    """
+    Invoke the routed agent, falling back to the default agent on an empty or failed answer.
+    The fallback answers the message already in the thread, it is not sent twice.
+    """
+    if route.agent_id == route.default_agent_id:
+        response, token_usage, thread_id = await agent_service.invoke(input)
+        response.route = route
+        return response, token_usage, thread_id
+
+    await agent_service.prepare()
+    await agent_service.send_message(input)
+
+    token_usage = []
+    retries = 0
+    try:
+        response, token_usage, thread_id = await agent_service.run(route.agent_id, ROUTED_MAX_ATTEMPTS)
+        if response.content and response.content.strip():
+            response.route = route
+            return response, token_usage, thread_id
+        retries = response.retries
+        fallback_reason = "empty answer"
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        fallback_reason = f"{type(e).__name__}: {e}"
+
+    logging.warning(
+        "Routed agent %s (%s) failed, falling back to %s: %s",
+        route.agent_id, route.question_class, route.default_agent_id, fallback_reason
+    )
+    response, fallback_usage, thread_id = await agent_service.run(route.default_agent_id)
+    response.retries += retries
+    response.route = route.model_copy(update={"fallback": True, "fallback_reason": fallback_reason})
+    return response, token_usage + fallback_usage, thread_id
@@ -0,0 +1,112 @@
+import hashlib
+import logging
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Any, Callable, Hashable, Tuple
+
+
+def request_key(thread_id: str | None, agent_id: str, message: str) -> Tuple[str, str] | None:
+    """
+    Idempotency key of a delivery: the thread plus a hash of what is asked on it.
+    Messages without a thread start a new conversation and are never coalesced,
+    two users may well send the same first question.
+    """
+    if not thread_id:
+        return None
+    digest = hashlib.sha256(f"{agent_id}\0{message}".encode("utf-8")).hexdigest()
+    return thread_id, digest
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into a single execution.
+    Callers arriving while the call is in flight wait for its result; callers arriving
+    within `window_seconds` after it completed get the cached result. Failures are not cached.
+
+    Function invocations run on worker threads of one process, so this is thread based
+    and only deduplicates deliveries that land on the same instance.
+    """
+
+    def __init__(self, window_seconds: float = 300.0, max_entries: int = 1024):
+        self._window_seconds = window_seconds
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._in_flight: dict[Hashable, Future] = {}
+        self._completed: OrderedDict[Hashable, Tuple[float, Any]] = OrderedDict()
+
+    def do(self, key: Hashable, fn: Callable[[], Any], timeout: float | None = None) -> Tuple[Any, bool]:
+        """
+        Run `fn` once per key and idempotency window.
+        Returns the result and whether it was shared with another delivery.
+        Raises `concurrent.futures.TimeoutError` when waiting on an in-flight call exceeds `timeout`.
+        """
+        with self._lock:
+            self._evict_expired()
+            if key in self._completed:
+                self._completed.move_to_end(key)
+                return self._completed[key][1], True
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._in_flight[key] = future
+
+        if not leader:
+            logging.info("Duplicate delivery attached to the in-flight request")
+            return future.result(timeout=timeout), True
+
+        try:
+            result = fn()
+        except BaseException as e:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            self._in_flight.pop(key, None)
+            self._completed[key] = (time.monotonic() + self._window_seconds, result)
+            while len(self._completed) > self._max_entries:
+                self._completed.popitem(last=False)
+        future.set_result(result)
+        return result, False
+
+    def _evict_expired(self) -> None:
+        now = time.monotonic()
+        expired = [key for key, (expires, _) in self._completed.items() if expires <= now]
+        for key in expired:
+            del self._completed[key]
+
+
+class LockTimeout(TimeoutError):
+    """Raised by `KeyedLocks.hold` when the lock is not acquired in time."""
+
+
+class KeyedLocks:
+    """
+    One lock per key, created on demand and dropped once nobody holds or waits on it.
+    Used to serialize runs on the same agent thread, Foundry rejects a new run while one is active.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+
+    @contextmanager
+    def hold(self, key: Hashable, timeout: float = -1):
+        """Hold the lock of `key`. Raises `LockTimeout` when it cannot be acquired within `timeout` seconds."""
+        with self._lock:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = threading.Lock()
+                self._locks[key] = lock
+        if not lock.acquire(timeout=timeout):
+            raise LockTimeout(f"Timed out waiting for lock {key}")
+        try:
+            yield
+        finally:
+            lock.release()
@@ -0,0 +1,274 @@
+"""
+# Change Feed Export Module
+
+## Description
+Streams the chat history container to local files through the Cosmos DB change feed.
+Records are written page by page as gzip-compressed JSONL (or Parquet) partitioned by
+date, so memory stays bounded by the page size. After every page the continuation
+token is persisted in a checkpoint file, so an interrupted export resumes where it
+stopped instead of starting from zero.
+
+Parquet output needs the optional `pyarrow` package, which is not part of the function
+app requirements; install it where the export runs.
+
+Any object exposing `query_items_change_feed(...)` with the `azure-cosmos` signature
+can be used as the source; `InMemoryChangeFeedContainer` is a local stand-in.
+
+## Usage
+from cosmos_utils.change_feed_export import ChangeFeedExporter
+exporter = ChangeFeedExporter(container, "exports/chats", drop_fields=["request.context"])
+exporter.run()
+
+python -m cosmos_utils.change_feed_export exports/chats --format parquet --drop request.context
+"""
+
+import argparse
+import gzip
+import json
+import os
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, Iterator, List, Literal, Tuple
+
+from cosmos_utils.telemetry import logger
+
+CHECKPOINT_FILE = "_checkpoint.json"
+SYSTEM_FIELDS = ("_rid", "_self", "_etag", "_attachments", "_lsn")
+
+ExportFormat = Literal["jsonl", "parquet"]
+
+
+class InMemoryChangeFeedContainer:
+    """
+    Minimal stand-in for `ContainerProxy` change feed reads.
+    Every write gets a monotonically increasing sequence number, like the LSN, and the
+    continuation token is the last sequence number read. Only the latest version of each item
+    is kept, so an update made after a checkpoint is returned by the next read.
+    """
+
+    def __init__(self, items: Iterable[dict] | None = None):
+        self._items: Dict[str, dict] = {}
+        self._sequence = 0
+        for item in items or []:
+            self.upsert_item(item)
+
+    def upsert_item(self, body: dict) -> dict:
+        self._sequence += 1
+        item = dict(body)
+        item.setdefault("_ts", int(datetime.now(timezone.utc).timestamp()))
+        item["_lsn"] = self._sequence
+        self._items[item["id"]] = item
+        return item
+
+    def query_items_change_feed(self, continuation: str | None = None, max_item_count: int | None = None, **kwargs):
+        return _InMemoryPager(self, int(continuation or 0), max_item_count)
+
+    def _changes_after(self, sequence: int, limit: int | None) -> List[dict]:
+        changes = sorted((i for i in self._items.values() if i["_lsn"] > sequence), key=lambda i: i["_lsn"])
+        return changes[:limit] if limit else changes
+
+
+class _InMemoryPager:
+    def __init__(self, container: InMemoryChangeFeedContainer, sequence: int, page_size: int | None):
+        self._container = container
+        self._sequence = sequence
+        self._page_size = page_size
+        self.continuation_token = str(sequence)
+
+    def by_page(self, continuation_token: str | None = None):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> List[dict]:
+        page = self._container._changes_after(self._sequence, self._page_size)
+        if not page:
+            raise StopIteration
+        self._sequence = page[-1]["_lsn"]
+        self.continuation_token = str(self._sequence)
+        return page
+
+
+def _drop_path(record: Dict[str, Any], path: str) -> None:
+    """Remove a dotted path such as `request.context` from a record, if present."""
+    head, _, rest = path.partition(".")
+    if head not in record:
+        return
+    if not rest:
+        record.pop(head, None)
+    elif isinstance(record[head], dict):
+        _drop_path(record[head], rest)
+
+
+def project_record(
+    record: Dict[str, Any],
+    fields: List[str] | None = None,
+    drop_fields: List[str] | None = None,
+    keep_system_fields: bool = False,
+) -> Dict[str, Any]:
+    """Apply the top-level field projection and the dotted drop list to a change feed record."""
+    if fields:
+        record = {key: record[key] for key in fields if key in record}
+    else:
+        record = dict(record)
+    if not keep_system_fields:
+        for key in SYSTEM_FIELDS:
+            record.pop(key, None)
+    for path in drop_fields or []:
+        if "." in path:
+            # Nested dicts are shared with the source record, copy before mutating
+            head = path.split(".", 1)[0]
+            if isinstance(record.get(head), dict):
+                record[head] = json.loads(json.dumps(record[head]))
+        _drop_path(record, path)
+    return record
+
+
+def record_date(record: Dict[str, Any]) -> str:
+    """Partition date of a chat record, taken from the request timestamp or `_ts`."""
+    request = record.get("request")
+    if isinstance(request, dict) and isinstance(request.get("datetime"), str):
+        return request["datetime"][:10]
+    if record.get("_ts"):
+        return datetime.fromtimestamp(record["_ts"], tz=timezone.utc).strftime("%Y-%m-%d")
+    return "unknown"
+
+
+class ChangeFeedExporter:
+    """
+    Incremental exporter of a container change feed to date-partitioned files.
+    Files are named `date=<YYYY-MM-DD>/part-<page>.<ext>`; a page interrupted before its
+    checkpoint is rewritten under the same name on resume, so no duplicates are left behind.
+    """
+
+    def __init__(
+        self,
+        container,
+        output_dir: str,
+        export_format: ExportFormat = "jsonl",
+        page_size: int = 500,
+        fields: List[str] | None = None,
+        drop_fields: List[str] | None = None,
+        keep_system_fields: bool = False,
+    ):
+        if export_format not in ("jsonl", "parquet"):
+            raise ValueError(f"Unsupported export format: {export_format}")
+        self._container = container
+        self._output_dir = output_dir
+        self._format = export_format
+        self._page_size = page_size
+        self._fields = fields
+        self._drop_fields = drop_fields
+        self._keep_system_fields = keep_system_fields
+        self._checkpoint_path = os.path.join(output_dir, CHECKPOINT_FILE)
+
+    def load_checkpoint(self) -> Dict[str, Any]:
+        if not os.path.exists(self._checkpoint_path):
+            return {"continuation": None, "page": 0, "records": 0}
+        with open(self._checkpoint_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def _save_checkpoint(self, checkpoint: Dict[str, Any]) -> None:
+        tmp_path = self._checkpoint_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, self._checkpoint_path)
+
+    def _pages(self, continuation: str | None) -> Iterator[Tuple[List[dict], str | None]]:
+        if continuation is None:
+            feed = self._container.query_items_change_feed(
+                is_start_from_beginning=True,
+                max_item_count=self._page_size,
+            )
+        else:
+            feed = self._container.query_items_change_feed(
+                continuation=continuation,
+                max_item_count=self._page_size,
+            )
+        pager = feed.by_page()
+        for page in pager:
+            yield list(page), pager.continuation_token
+
+    def _write_partition(self, date: str, page_number: int, records: List[dict]) -> str:
+        directory = os.path.join(self._output_dir, f"date={date}")
+        os.makedirs(directory, exist_ok=True)
+        extension = "jsonl.gz" if self._format == "jsonl" else "parquet"
+        path = os.path.join(directory, f"part-{page_number:08d}.{extension}")
+        tmp_path = path + ".tmp"
+
+        if self._format == "jsonl":
+            with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False))
+                    f.write("\n")
+        else:
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError as e:
+                raise ImportError("Parquet export requires the 'pyarrow' package") from e
+            pq.write_table(pa.Table.from_pylist(records), tmp_path, compression="zstd")
+
+        os.replace(tmp_path, path)
+        return path
+
+    def run(self, max_pages: int | None = None) -> Dict[str, Any]:
+        """
+        Export every change since the last checkpoint.
+        Returns the updated checkpoint.
+        """
+        os.makedirs(self._output_dir, exist_ok=True)
+        checkpoint = self.load_checkpoint()
+        pages_read = 0
+
+        for items, continuation in self._pages(checkpoint["continuation"]):
+            if items:
+                partitions: Dict[str, List[dict]] = {}
+                for item in items:
+                    record = project_record(item, self._fields, self._drop_fields, self._keep_system_fields)
+                    partitions.setdefault(record_date(item), []).append(record)
+                for date, records in partitions.items():
+                    self._write_partition(date, checkpoint["page"], records)
+                checkpoint["page"] += 1
+                checkpoint["records"] += len(items)
+
+            checkpoint["continuation"] = continuation
+            checkpoint["updated"] = datetime.now(timezone.utc).isoformat()
+            self._save_checkpoint(checkpoint)
+            logger.debug("Exported change feed page with %d items", len(items))
+
+            pages_read += 1
+            if max_pages is not None and pages_read >= max_pages:
+                break
+
+        logger.info("Change feed export up to date: %d records in total", checkpoint["records"])
+        return checkpoint
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Export the chat history change feed to local files.")
+    parser.add_argument("output_dir")
+    parser.add_argument("--format", choices=["jsonl", "parquet"], default="jsonl")
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument("--fields", nargs="*", help="Top-level fields to keep (default: all)")
+    parser.add_argument("--drop", nargs="*", default=[], help="Dotted fields to drop, e.g. request.context")
+    parser.add_argument("--max-pages", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    from cosmos_utils.chat_history_models import ConversationChat
+    from cosmos_utils.cosmos_utils_orm import instance_connection
+
+    container = instance_connection(lambda model: model._meta.container)(ConversationChat)
+    exporter = ChangeFeedExporter(
+        container,
+        args.output_dir,
+        export_format=args.format,
+        page_size=args.page_size,
+        fields=args.fields,
+        drop_fields=args.drop,
+    )
+    exporter.run(max_pages=args.max_pages)
+
+
+if __name__ == "__main__":
+    main()
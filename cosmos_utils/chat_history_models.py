@@ -60,6 +60,7 @@ class Citation (BaseModel):
 
 
 class TokenUsage(BaseModel):
+    agent_id: str | None = None                 # Agent that spent the tokens
     total_tokens: int | None = None
     prompt_tokens: int | None = None
     completion_tokens: int | None = None
@@ -76,6 +77,16 @@ class Agent(BaseModel):
     agent_description: str | None = None
 
 
+class AgentRoute(BaseModel):
+    """Routing decision taken before invoking the agent."""
+    question_class: Literal["lookup", "comparison", "analysis"]
+    tables: int = 0                             # Tables found in the context
+    agent_id: str                               # Agent chosen for the class
+    default_agent_id: str                       # Agent requested by the caller
+    fallback: bool = False                      # True when the default agent had to answer
+    fallback_reason: str | None = None
+
+
 class ConversationChatResponse(BaseModel):
     """
     Agent output message sent to the user.
@@ -93,6 +104,7 @@ class ConversationChatResponse(BaseModel):
     safety_alert: SafetyAlert | None = None     # None
     datetime: str = datetime_factory()
     retries: int = 0
+    route: AgentRoute | None = None
 
 
 class Fingerprint(BaseModel):
@@ -100,6 +112,18 @@ class Fingerprint(BaseModel):
     datetime: str = datetime_factory()
 
 
+class ThreadCompaction(BaseModel):
+    """
+    Compaction applied to a long thread before the agent run.
+    With 'rollover' the conversation continues on a new thread (session_id) seeded with a summary.
+    """
+    strategy: Literal["truncate", "rollover"]
+    previous_session_id: str | None = None      # Thread the conversation was rolled over from
+    prompt_tokens: int | None = None            # Prompt tokens of the last run on the old thread
+    turns: int | None = None                    # User messages counted on the old thread
+    datetime: str = datetime_factory()
+
+
 class ConversationChat(CosmosModel):
     """
     This model represents a conversation chat session.
@@ -112,6 +136,7 @@ class ConversationChat(CosmosModel):
     request: ConversationChatInput                      # User message
     response: ConversationChatResponse | None = None    # Agent response
     updated: Fingerprint | None = None                  # None
+    compaction: ThreadCompaction | None = None          # Set when the thread was compacted
 
     class Meta:
         database_name: str = os.getenv("AZURE_COSMOS_DB_NAME")
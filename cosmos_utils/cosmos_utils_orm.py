@@ -174,17 +174,17 @@ class CosmosModel(PydanticModel, metaclass=Metaclass):
             upserted = self._meta.container.upsert_item(data)
             
             # Use logger instead of print to avoid encoding issues
-            logger.info(f"Successfully saved item with ID: {upserted.get('id', 'unknown')}")
+            logger.debug("Successfully saved item with ID: %s", upserted.get('id', 'unknown'))
             self.model_validate(upserted)
             return self
         except Exception as e:
-            logger.error(f"Error saving to Cosmos DB: {str(e)}")
+            logger.error("Error saving to Cosmos DB: %s", e)
             # If there's an encoding error, try with cleaned data
             if "codec" in str(e) or "charmap" in str(e):
                 logger.warning("Retrying save with Unicode character cleaning...")
                 data = self._clean_unicode_data(self.model_dump(by_alias=True))
                 upserted = self._meta.container.upsert_item(data)
-                logger.info(f"Successfully saved item with cleaned data, ID: {upserted.get('id', 'unknown')}")
+                logger.debug("Successfully saved item with cleaned data, ID: %s", upserted.get('id', 'unknown'))
                 self.model_validate(upserted)
                 return self
             else:
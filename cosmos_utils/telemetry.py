@@ -5,15 +5,30 @@
 This module initializes telemetry for the botframework application using Azure Application Insights.
 It configures logging and tracing to monitor application performance and behavior.
 
+It also provides the structured logging helpers used on the request path:
+- `configure_logging` applies logger levels (`LOG_LEVELS`) and per-level sampling (`LOG_SAMPLING`) from the environment.
+- `RequestLog` collects one consolidated record per request (stage timings, sizes, outcome).
+- `LazyJson` defers serialization until a record is actually emitted, with secrets redacted and fields size-capped.
+
 ## Usage
 from utils.telemetry import logger, tracer
 logger.info("Application started")
 with tracer.span(name="example_span"):
     pass
+
+configure_logging()  # e.g. LOG_LEVELS="azure=WARNING,requests=WARNING" LOG_SAMPLING="DEBUG=0,INFO=0.2"
+request_log = RequestLog()
+request_log.set(agent_id="asst_x", message_chars=120)
+request_log.emit()
 """
 
+import json
 import os
 import logging
+import random
+import re
+import time
+from typing import Any, Dict
 from opencensus.ext.azure.trace_exporter import AzureExporter
 from opencensus.trace.tracer import Tracer
 from opencensus.trace.samplers import ProbabilitySampler
@@ -37,3 +52,130 @@ if APPINSIGHTS_KEY:
 else:
     tracer = Tracer()
     logger.warning("⚠️ APPINSIGHTS_INSTRUMENTATION_KEY is missing. Telemetry is not fully enabled.")
+
+
+# Loggers that are too noisy at INFO; LOG_LEVELS entries override or extend these
+DEFAULT_LOG_LEVELS = {
+    "azure": "WARNING",
+    "azure.core.pipeline.policies.http_logging_policy": "WARNING",
+    "azure.storage": "WARNING",
+    "requests": "WARNING",
+    "urllib3": "WARNING",
+}
+MAX_FIELD_CHARS = int(os.getenv("LOG_MAX_FIELD_CHARS", "512"))
+REDACTED = "***"
+SECRET_KEY_PATTERN = re.compile(r"(code|key|secret|token|password|signature|sig)$", re.IGNORECASE)
+SECRET_QUERY_PATTERN = re.compile(r"\b((?:code|key|secret|token|password|sig)=)[^&\s]+", re.IGNORECASE)
+
+
+def redact(value: Any) -> Any:
+    """Mask values of secret-looking keys and secret query parameters inside strings."""
+    if isinstance(value, dict):
+        return {
+            key: REDACTED if isinstance(key, str) and SECRET_KEY_PATTERN.search(key) and val else redact(val)
+            for key, val in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    if isinstance(value, str):
+        return SECRET_QUERY_PATTERN.sub(rf"\1{REDACTED}", value)
+    return value
+
+
+def truncate(value: Any, max_chars: int = MAX_FIELD_CHARS) -> Any:
+    """Cap strings, and the serialized form of collections, to `max_chars`."""
+    if isinstance(value, (dict, list, tuple)):
+        text = json.dumps(value, ensure_ascii=False, default=str)
+        return value if len(text) <= max_chars else truncate(text, max_chars)
+    if isinstance(value, str) and len(value) > max_chars:
+        return f"{value[:max_chars]}...(+{len(value) - max_chars} chars)"
+    return value
+
+
+class LazyJson:
+    """Log argument serialized only when the record is formatted, after redaction and capping."""
+
+    __slots__ = ("payload", "max_chars")
+
+    def __init__(self, payload: Any, max_chars: int = MAX_FIELD_CHARS):
+        self.payload = payload
+        self.max_chars = max_chars
+
+    def __str__(self) -> str:
+        payload = redact(self.payload)
+        if isinstance(payload, dict):
+            payload = {key: truncate(val, self.max_chars) for key, val in payload.items()}
+        else:
+            payload = truncate(payload, self.max_chars)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keep a fraction of the records of each level, e.g. {logging.INFO: 0.2}. Unlisted levels are kept."""
+
+    def __init__(self, rates: Dict[int, float]):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.rates.get(record.levelno, 1.0)
+        return rate >= 1.0 or (rate > 0.0 and random.random() < rate)
+
+
+def _parse_pairs(spec: str | None) -> Dict[str, str]:
+    pairs = {}
+    for item in (spec or "").split(","):
+        name, sep, value = item.partition("=")
+        if sep and name.strip() and value.strip():
+            pairs[name.strip()] = value.strip()
+    return pairs
+
+
+def configure_logging() -> None:
+    """
+    Apply `LOG_LEVELS` (e.g. "azure=WARNING,botframework=DEBUG") and `LOG_SAMPLING`
+    (e.g. "DEBUG=0,INFO=0.2") from the environment. Safe to call again to pick up new values.
+    """
+    levels = {**DEFAULT_LOG_LEVELS, **_parse_pairs(os.getenv("LOG_LEVELS"))}
+    for name, level in levels.items():
+        try:
+            logging.getLogger(name).setLevel(level.upper())
+        except ValueError:
+            logger.warning("Ignoring invalid LOG_LEVELS level for %s: %s", name, level)
+
+    rates = {}
+    for level, rate in _parse_pairs(os.getenv("LOG_SAMPLING")).items():
+        try:
+            rates[logging.getLevelName(level.upper())] = float(rate)
+        except ValueError:
+            logger.warning("Ignoring invalid LOG_SAMPLING rate for %s: %s", level, rate)
+
+    handlers = logging.getLogger().handlers + logger.handlers
+    for handler in handlers:
+        for existing in [f for f in handler.filters if isinstance(f, SamplingFilter)]:
+            handler.removeFilter(existing)
+        if rates:
+            handler.addFilter(SamplingFilter(rates))
+
+
+class RequestLog:
+    """
+    Consolidated record of one request: identifiers, sizes, stage timings and outcome.
+    Fields are collected along the request and emitted once, as a single record.
+    """
+
+    def __init__(self, event: str = "request"):
+        self.event = event
+        self.fields: Dict[str, Any] = {}
+        self._start = time.perf_counter()
+
+    def set(self, **fields: Any) -> "RequestLog":
+        self.fields.update(fields)
+        return self
+
+    def emit(self, level: int = logging.INFO) -> None:
+        if not logger.isEnabledFor(level):
+            return
+        self.fields["duration_ms"] = round((time.perf_counter() - self._start) * 1000)
+        # Serialized, redacted and capped by LazyJson only if a handler formats the record
+        logger.log(level, "%s %s", self.event, LazyJson(self.fields))
@@ -0,0 +1,387 @@
+"""
+# Usage Rollups Module
+
+## Description
+Pre-aggregated token usage and latency totals per agent, per hour and per day.
+Rollups are accumulated in memory from the persistence path and flushed in batches
+to a dedicated Cosmos container partitioned by `agent_id`. Flushing happens on a
+background daemon thread, never on the request path. Every flush carries a batch id
+derived from the conversations it contains, so replaying a batch never double counts.
+
+Counters not yet flushed live only in memory: if the worker is recycled or killed,
+up to `max_age_seconds` (or `batch_size` conversations) of usage can be lost.
+
+## Usage
+from cosmos_utils.usage_rollups import rollup_buffer, UsageRollup, Granularity
+rollup_buffer.add(conversation)
+rows = UsageRollup.query_range(agent_id="asst_x", granularity=Granularity.DAY, start="2025-01-01", end="2025-01-31")
+totals = UsageRollup.summarize(rows)
+"""
+
+import atexit
+import hashlib
+import os
+import threading
+import time
+from datetime import datetime
+from enum import Enum
+from typing import Dict, Iterable, List, Tuple
+
+from azure.core import MatchConditions
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosResourceExistsError,
+    CosmosResourceNotFoundError,
+)
+from pydantic import BaseModel, Field
+
+from cosmos_utils.chat_history_models import ConversationChat
+from cosmos_utils.cosmos_utils_orm import CosmosModel, instance_connection
+from cosmos_utils.telemetry import logger
+
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+# Upper bounds (ms) of the latency histogram; anything slower lands in the overflow bucket
+LATENCY_BUCKETS_MS = (500, 1000, 2000, 5000, 10000, 20000, 30000, 60000)
+LATENCY_OVERFLOW_BUCKET = f"gt_{LATENCY_BUCKETS_MS[-1]}"
+
+# Number of applied batch ids kept on each rollup document for idempotency
+APPLIED_BATCHES_HISTORY = 50
+MAX_WRITE_ATTEMPTS = 5
+
+
+class Granularity(str, Enum):
+    """Time bucket size of a rollup document."""
+
+    HOUR = "hour"
+    DAY = "day"
+
+
+def parse_datetime(value: str | None) -> datetime | None:
+    """Parse a timestamp produced by `datetime_factory`."""
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, DATETIME_FORMAT)
+    except ValueError:
+        return None
+
+
+def bucket_key(moment: datetime, granularity: Granularity) -> str:
+    """Sortable bucket label, e.g. `2025-01-31T13` (hour) or `2025-01-31` (day)."""
+    if granularity == Granularity.HOUR:
+        return moment.strftime("%Y-%m-%dT%H")
+    return moment.strftime("%Y-%m-%d")
+
+
+def latency_bucket(latency_ms: int) -> str:
+    for upper in LATENCY_BUCKETS_MS:
+        if latency_ms <= upper:
+            return f"le_{upper}"
+    return LATENCY_OVERFLOW_BUCKET
+
+
+class RollupDelta(BaseModel):
+    """Counters accumulated in memory for one rollup document."""
+
+    request_count: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    total_tokens: int = 0
+    retries: int = 0
+    latency_ms_total: int = 0
+    latency_buckets: Dict[str, int] = Field(default_factory=dict)
+    conversation_ids: List[str] = Field(default_factory=list)
+
+    @property
+    def batch_id(self) -> str:
+        """Deterministic id of the batch, so re-flushing the same conversations is a no-op."""
+        digest = hashlib.sha1("|".join(sorted(self.conversation_ids)).encode("utf-8"))
+        return digest.hexdigest()
+
+    def merge(self, other: "RollupDelta") -> None:
+        self.request_count += other.request_count
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.total_tokens += other.total_tokens
+        self.retries += other.retries
+        self.latency_ms_total += other.latency_ms_total
+        for key, count in other.latency_buckets.items():
+            self.latency_buckets[key] = self.latency_buckets.get(key, 0) + count
+        self.conversation_ids.extend(other.conversation_ids)
+
+
+class UsageRollup(CosmosModel):
+    """
+    Aggregated usage of one agent over one hour or one day.
+    The document id is `<agent_id>:<granularity>:<bucket>`.
+    """
+    agent_id: str
+    granularity: Granularity
+    bucket: str
+    request_count: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    total_tokens: int = 0
+    retries: int = 0
+    latency_ms_total: int = 0
+    latency_buckets: Dict[str, int] = Field(default_factory=dict)
+    applied_batches: List[str] = Field(default_factory=list)
+
+    class Meta:
+        database_name: str = os.getenv("AZURE_COSMOS_DB_NAME")
+        partition_key: str = "agent_id"
+        container_name: str = os.getenv("AZURE_COSMOS_DB_ROLLUP_CONTAINER", "usage_rollups")
+
+    @staticmethod
+    def document_id(agent_id: str, granularity: Granularity, bucket: str) -> str:
+        return f"{agent_id}:{granularity.value}:{bucket}"
+
+    @classmethod
+    @instance_connection
+    def _container(cls):
+        return cls._meta.container
+
+    @classmethod
+    def apply_delta(cls, agent_id: str, granularity: Granularity, bucket: str, delta: RollupDelta) -> bool:
+        """
+        Apply a delta with optimistic concurrency.
+        Returns False when the batch had already been applied.
+        """
+        container = cls._container()
+        doc_id = cls.document_id(agent_id, granularity, bucket)
+        batch_id = delta.batch_id
+
+        for _ in range(MAX_WRITE_ATTEMPTS):
+            try:
+                current = container.read_item(item=doc_id, partition_key=agent_id)
+            except CosmosResourceNotFoundError:
+                current = None
+
+            rollup = cls(**current) if current else cls(
+                id=doc_id, agent_id=agent_id, granularity=granularity, bucket=bucket
+            )
+            if batch_id in rollup.applied_batches:
+                logger.debug("Rollup batch %s already applied to %s", batch_id, doc_id)
+                return False
+
+            rollup.request_count += delta.request_count
+            rollup.prompt_tokens += delta.prompt_tokens
+            rollup.completion_tokens += delta.completion_tokens
+            rollup.total_tokens += delta.total_tokens
+            rollup.retries += delta.retries
+            rollup.latency_ms_total += delta.latency_ms_total
+            for key, count in delta.latency_buckets.items():
+                rollup.latency_buckets[key] = rollup.latency_buckets.get(key, 0) + count
+            rollup.applied_batches = (rollup.applied_batches + [batch_id])[-APPLIED_BATCHES_HISTORY:]
+
+            body = rollup.model_dump(by_alias=True, mode="json", exclude_none=True)
+            try:
+                if current:
+                    container.replace_item(
+                        item=doc_id,
+                        body=body,
+                        etag=current["_etag"],
+                        match_condition=MatchConditions.IfNotModified,
+                    )
+                else:
+                    container.create_item(body)
+                return True
+            except (CosmosAccessConditionFailedError, CosmosResourceExistsError):
+                # Someone else wrote the document in between, re-read and try again
+                continue
+
+        raise RuntimeError(f"Could not apply rollup batch {batch_id} to {doc_id} after {MAX_WRITE_ATTEMPTS} attempts")
+
+    @classmethod
+    def query_range(cls, agent_id: str, granularity: Granularity, start: str, end: str) -> List["UsageRollup"]:
+        """
+        Read the rollups of an agent whose bucket falls in [start, end].
+        Bounds are bucket labels (or prefixes of them), so `end="2025-01-31"` includes every hour of that day.
+        """
+        container = cls._container()
+        results = container.query_items(
+            query=(
+                "SELECT * FROM c WHERE c.agent_id = @agent_id AND c.granularity = @granularity "
+                "AND c.bucket >= @start AND c.bucket <= @end"
+            ),
+            parameters=[
+                {"name": "@agent_id", "value": agent_id},
+                {"name": "@granularity", "value": granularity.value},
+                {"name": "@start", "value": start},
+                {"name": "@end", "value": end + "\uffff"},
+            ],
+            partition_key=agent_id,
+        )
+        return sorted((cls(**r) for r in results), key=lambda r: r.bucket)
+
+    @staticmethod
+    def summarize(rollups: Iterable["UsageRollup"]) -> dict:
+        """Collapse several rollups into a single totals dictionary."""
+        totals = RollupDelta()
+        for rollup in rollups:
+            totals.merge(RollupDelta(
+                request_count=rollup.request_count,
+                prompt_tokens=rollup.prompt_tokens,
+                completion_tokens=rollup.completion_tokens,
+                total_tokens=rollup.total_tokens,
+                retries=rollup.retries,
+                latency_ms_total=rollup.latency_ms_total,
+                latency_buckets=dict(rollup.latency_buckets),
+            ))
+        summary = totals.model_dump(exclude={"conversation_ids"})
+        summary["avg_latency_ms"] = (
+            totals.latency_ms_total / totals.request_count if totals.request_count else None
+        )
+        return summary
+
+
+RollupKey = Tuple[str, Granularity, str]
+
+
+def conversation_deltas(conversation: ConversationChat) -> Dict[RollupKey, RollupDelta]:
+    """Split a saved conversation into the hourly and daily deltas it contributes to."""
+    if conversation.response is None:
+        return {}
+
+    started = parse_datetime(conversation.request.datetime)
+    finished = parse_datetime(conversation.response.datetime)
+    moment = started or finished or datetime.now()
+    latency_ms = None
+    if started and finished:
+        latency_ms = max(int((finished - started).total_seconds() * 1000), 0)
+
+    # Requests, retries and latency belong to the agent that answered;
+    # tokens belong to the agent that spent them
+    per_agent: Dict[str, RollupDelta] = {}
+    answering_agent = conversation.response.agent_id
+    request_delta = per_agent.setdefault(answering_agent, RollupDelta())
+    request_delta.request_count = 1
+    request_delta.retries = conversation.response.retries or 0
+    if latency_ms is not None:
+        request_delta.latency_ms_total = latency_ms
+        request_delta.latency_buckets = {latency_bucket(latency_ms): 1}
+
+    for usage in conversation.token_usage or []:
+        delta = per_agent.setdefault(usage.agent_id or answering_agent, RollupDelta())
+        delta.prompt_tokens += usage.prompt_tokens or 0
+        delta.completion_tokens += usage.completion_tokens or 0
+        delta.total_tokens += usage.total_tokens or 0
+
+    deltas: Dict[RollupKey, RollupDelta] = {}
+    for agent_id, delta in per_agent.items():
+        delta.conversation_ids = [conversation.id]
+        for granularity in Granularity:
+            deltas[(agent_id, granularity, bucket_key(moment, granularity))] = delta.model_copy(deep=True)
+    return deltas
+
+
+class UsageRollupBuffer:
+    """
+    Thread-safe accumulator of rollup deltas.
+    A daemon flusher thread, started on the first `add`, flushes when `batch_size` conversations
+    are pending or the oldest one is older than `max_age_seconds`, also on an idle instance.
+    """
+
+    def __init__(self, batch_size: int = 20, max_age_seconds: float = 60.0):
+        self._batch_size = batch_size
+        self._max_age_seconds = max_age_seconds
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._flusher: threading.Thread | None = None
+        self._pending: Dict[RollupKey, RollupDelta] = {}
+        self._retry: List[Tuple[RollupKey, RollupDelta]] = []
+        self._pending_conversations = 0
+        self._oldest: float | None = None
+
+    def add(self, conversation: ConversationChat) -> None:
+        """Buffer the deltas of a conversation. Never writes to Cosmos on the caller's thread."""
+        deltas = conversation_deltas(conversation)
+        if not deltas:
+            return
+        with self._lock:
+            self._merge(deltas)
+            self._pending_conversations += 1
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            self._ensure_flusher()
+        if self.should_flush():
+            self._wakeup.set()
+
+    def _ensure_flusher(self) -> None:
+        if self._flusher is None or not self._flusher.is_alive():
+            self._flusher = threading.Thread(target=self._flush_loop, name="usage-rollup-flusher", daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self) -> None:
+        # Wake up at least once per max age, so an idle instance still flushes its counters
+        interval = max(self._max_age_seconds / 2, 1.0)
+        while True:
+            self._wakeup.wait(timeout=interval)
+            self._wakeup.clear()
+            try:
+                if self.should_flush():
+                    self.flush()
+            except Exception as e:
+                logger.error("Error flushing usage rollups: %s", e)
+
+    def should_flush(self) -> bool:
+        with self._lock:
+            if not self._pending and not self._retry:
+                return False
+            return (
+                self._pending_conversations >= self._batch_size
+                or time.monotonic() - self._oldest >= self._max_age_seconds
+            )
+
+    def flush(self) -> int:
+        """Write pending deltas. Failed ones are put back and retried on the next flush."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._pending_conversations = 0
+                self._oldest = None
+
+                retry, self._retry = self._retry, []
+
+            # Failed batches are retried as-is so their batch id, and therefore idempotency, is preserved
+            failed: List[Tuple[RollupKey, RollupDelta]] = []
+            written = 0
+            for key, delta in retry + list(pending.items()):
+                agent_id, granularity, bucket = key
+                try:
+                    if UsageRollup.apply_delta(agent_id, granularity, bucket, delta):
+                        written += 1
+                except Exception as e:
+                    logger.error("Error writing usage rollup %s: %s", key, e)
+                    failed.append((key, delta))
+
+            if failed:
+                with self._lock:
+                    self._retry.extend(failed)
+                    if self._oldest is None:
+                        self._oldest = time.monotonic()
+            return written
+
+    def _merge(self, deltas: Dict[RollupKey, RollupDelta]) -> None:
+        for key, delta in deltas.items():
+            if key in self._pending:
+                self._pending[key].merge(delta)
+            else:
+                self._pending[key] = delta
+
+
+rollup_buffer = UsageRollupBuffer(
+    batch_size=int(os.getenv("USAGE_ROLLUP_BATCH_SIZE", "20")),
+    max_age_seconds=float(os.getenv("USAGE_ROLLUP_MAX_AGE_SECONDS", "60")),
+)
+
+
+# Best effort only: atexit does not run when the worker is killed
+@atexit.register
+def _flush_on_exit():
+    try:
+        rollup_buffer.flush()
+    except Exception as e:
+        logger.error("Error flushing usage rollups on exit: %s", e)
@@ -4,15 +4,38 @@ import os
 import json
 import asyncio
 import requests
-import traceback
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import nullcontext
 from cosmos_utils.chat_history_models import ConversationChat, ConversationChatInput, Fingerprint, datetime_factory
+from cosmos_utils.telemetry import LazyJson, RequestLog, configure_logging, redact
+from cosmos_utils.usage_rollups import rollup_buffer
 from agent_services.agent import AgentService
+from agent_services.deadline import Deadline, DeadlineExceeded
+from agent_services.pipeline import StageGraph
+from agent_services.routing import choose_route, invoke_routed
+from agent_services.single_flight import KeyedLocks, LockTimeout, SingleFlight, request_key
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
+# Logger levels and per-level sampling come from LOG_LEVELS / LOG_SAMPLING, see cosmos_utils/telemetry.py
+configure_logging()
+
+# Upper bound for the search call, the request deadline may cut it shorter
+SEARCH_TIMEOUT_SECONDS = float(os.environ.get("SEARCH_TIMEOUT_SECONDS", "30"))
+
+# Teams and the bot gateway redeliver slow messages; duplicates share the first delivery's answer
+single_flight = SingleFlight(window_seconds=float(os.environ.get("IDEMPOTENCY_WINDOW_SECONDS", "300")))
+thread_locks = KeyedLocks()
+
+# Chat history is written after the response is built, outside the request's deadline
+persistence_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="chat-history")
+
 
 @app.route(route="agent_httptrigger")
 def agent_httptrigger(req: func.HttpRequest) -> func.HttpResponse:
-    logging.info('Python HTTP trigger function processed a request.')
+    logging.debug('Python HTTP trigger function processed a request.')
+    deadline = Deadline.from_env()
+    request_log = RequestLog()
 
     message = req.params.get('message')
     agent_id = req.params.get('agent_id')
@@ -29,103 +52,211 @@ def agent_httptrigger(req: func.HttpRequest) -> func.HttpResponse:
             agent_id = req_body.get('agent_id')
             thread_id = req_body.get('thread_id')
             thread_id_filter = req_body.get('thread_id_filter')
-    logging.info(f"Received message: {message}, agent_id: {agent_id}, thread_id: {thread_id}")
+    request_log.set(agent_id=agent_id, thread_id=thread_id, message_chars=len(message or ""))
     if not message or not agent_id:
+        request_log.set(status=400).emit(logging.WARNING)
         return func.HttpResponse(
             "Pass in a message and agent_id in the query string or in the request body for a personalized response.",
             status_code=400
         )
 
     try:
-        # Get context from search endpoint
-        context = ""
-        search_endpoint = os.environ.get("FUNCTION_ENDPOINT")
-        search_params = {
-            "q": message,
-            "code": os.environ.get("FUNCTION_KEY"),
-            "threadid": thread_id_filter or ""
-        }
-        logging.info(f"Calling search endpoint with params: {search_params}")
-        try:
-            search_response = requests.get(search_endpoint, params=search_params)
-            search_response.raise_for_status()
-            search_result = search_response.json()
-            filtered_results = search_result.get("parsed_date", [])
-            logging.info(f"Filtered results: {filtered_results}")
-            thread_id_filter = search_result.get("thread_id", [])
-            logging.info(f"Thread ID filter updated: {thread_id_filter}")
-            docs = search_result.get("semantic_documents", [])
-            num_docs = search_result.get("num_documents", [])
-            logging.info(f"Number of documents found: {num_docs}")
-            logging.info(f"Documentos obtenidos: {len(docs)}")
-            header = (
-                f"Numero de documentos: {num_docs}\n"
-            )
-
-            # Detalles por documento (opcional)
-            doc_blocks = [
-                (
-                    f"Titulo de la tabla: {doc.get('metadata_spo_item_table_title')}\n"
-                    f"Markdown:\n{doc.get('markdown_content', '')}\n\n"
-                    f"Enlace al documento: {doc.get('metadata_spo_item_path')}\n\n"
-                    f"Fecha del reporte: {doc.get('metadata_spo_item_release_date')}\n\n\n\n\n"
-                )
-                for doc in docs
-            ]
-
-            context = header if not doc_blocks else header + "\n\n" + "\n\n".join(doc_blocks)
-            # logging.info(f"Contexto obtenido: {context}")
-            logging.info(f"Thread ID actualizado: {thread_id}")
-            message_with_context = f"Pregunta:\n{message}\n\nContexto:\n{context}"
-        except Exception as e:
-            logging.error(f"Error al obtener documentos: {str(e)}")
-            message_with_context = message
-
-        # Run the async function call
-        result = asyncio.run(function_call_async(message_with_context, agent_id, thread_id, thread_id_filter, context))
+        result = handle_request(message, agent_id, thread_id, thread_id_filter, deadline, request_log)
 
+        request_log.set(status=200).emit()
         return func.HttpResponse(
             json.dumps(result),
             status_code=200,
             mimetype="application/json"
         )
 
+    except DeadlineExceeded as e:
+        request_log.set(status=504, error=str(e), timeout_stage=e.stage).emit(logging.WARNING)
+        return func.HttpResponse(
+            json.dumps({**e.to_dict(), "thread_id": thread_id, "agent_id": agent_id}),
+            status_code=504,
+            mimetype="application/json"
+        )
+
     except Exception as e:
-        logging.error(f"An error occurred: {str(e)}")
         # Include more detailed error information for debugging
-        logging.error(traceback.format_exc())
+        logging.error("An error occurred: %s", e, exc_info=True)
+        request_log.set(status=500, error=str(e)).emit(logging.ERROR)
         return func.HttpResponse(
             "Internal Server Error: " + str(e),
             status_code=500
         )
 
 
+def handle_request(
+    message: str,
+    agent_id: str,
+    thread_id: str = None,
+    thread_id_filter: str = None,
+    deadline: Deadline | None = None,
+    request_log: RequestLog | None = None
+) -> dict:
+    """
+    Run a request once per (thread_id, message) within the idempotency window.
+    Redeliveries attach to the in-flight run or get the completed response,
+    and distinct messages on the same thread run one after another.
+    """
+    timeout = deadline.remaining() if deadline else None
+
+    def run():
+        # New conversations have no thread to serialize on
+        lock = thread_locks.hold(thread_id, timeout=deadline.remaining() if deadline else -1) if thread_id else nullcontext()
+        try:
+            with lock:
+                # Search, client, agent and thread setup run concurrently inside the pipeline
+                return asyncio.run(function_call_async(
+                    message, agent_id, thread_id, thread_id_filter, deadline, request_log
+                ))
+        except LockTimeout:
+            raise deadline.exceeded("thread_lock")
+
+    key = request_key(thread_id, agent_id, message)
+    if key is None:
+        return run()
+    try:
+        result, shared = single_flight.do(key, run, timeout=timeout)
+    except FutureTimeoutError:
+        raise deadline.exceeded("single_flight")
+    if request_log:
+        request_log.set(deduplicated=shared)
+    return result
+
+
+def fetch_search_context(
+    message: str,
+    thread_id_filter: str = None,
+    deadline: Deadline | None = None,
+    request_log: RequestLog | None = None
+) -> tuple[str, str, str]:
+    """
+    Get context from the search endpoint.
+    Returns the message with its context, the context alone and the updated thread_id_filter.
+    A failed or timed out search falls back to the bare message.
+    """
+    timeout = deadline.timeout(cap=SEARCH_TIMEOUT_SECONDS) if deadline else SEARCH_TIMEOUT_SECONDS
+    context = ""
+    search_endpoint = os.environ.get("FUNCTION_ENDPOINT")
+    search_params = {
+        "q": message,
+        "code": os.environ.get("FUNCTION_KEY"),
+        "threadid": thread_id_filter or ""
+    }
+    logging.debug("Calling search endpoint with params: %s", LazyJson(search_params))
+    try:
+        search_response = requests.get(search_endpoint, params=search_params, timeout=timeout)
+        search_response.raise_for_status()
+        search_result = search_response.json()
+        filtered_results = search_result.get("parsed_date", [])
+        logging.debug("Filtered results: %s", LazyJson(filtered_results))
+        thread_id_filter = search_result.get("thread_id", [])
+        logging.debug("Thread ID filter updated: %s", thread_id_filter)
+        docs = search_result.get("semantic_documents", [])
+        num_docs = search_result.get("num_documents", [])
+        header = (
+            f"Numero de documentos: {num_docs}\n"
+        )
+
+        # Detalles por documento (opcional)
+        doc_blocks = [
+            (
+                f"Titulo de la tabla: {doc.get('metadata_spo_item_table_title')}\n"
+                f"Markdown:\n{doc.get('markdown_content', '')}\n\n"
+                f"Enlace al documento: {doc.get('metadata_spo_item_path')}\n\n"
+                f"Fecha del reporte: {doc.get('metadata_spo_item_release_date')}\n\n\n\n\n"
+            )
+            for doc in docs
+        ]
+
+        context = header if not doc_blocks else header + "\n\n" + "\n\n".join(doc_blocks)
+        message_with_context = f"Pregunta:\n{message}\n\nContexto:\n{context}"
+        if request_log:
+            request_log.set(num_documents=num_docs, documents=len(docs), context_chars=len(context))
+    except Exception as e:
+        # requests errors embed the full URL, including the `code` function key
+        error = redact(str(e))
+        logging.error("Error al obtener documentos: %s", error)
+        message_with_context = message
+        if request_log:
+            request_log.set(search_error=error)
+
+    return message_with_context, context, thread_id_filter
+
+
 async def function_call_async(
     message: str,
     agent_id: str,
     thread_id: str = None,
     thread_id_filter: str = None,
-    context: str = ""
+    deadline: Deadline | None = None,
+    request_log: RequestLog | None = None,
 ) -> dict:
     """
     Async function to handle agent invocation and chat history saving.
     Based on the provided function_call logic.
+
+    The request runs as a stage graph: search, client setup, agent lookup and
+    thread get/create overlap, and only `run` (messages.create + agent run) waits for all of them.
+    The question is routed to an agent by complexity once the search context is known.
+    When the deadline expires, running stages are cancelled and `DeadlineExceeded` is raised.
     """
+    agent_service = None
     try:
+        started = datetime_factory()
+        agent_service = AgentService(thread_id=thread_id, agent_id=agent_id, deadline=deadline)
+
+        async def search_stage(_):
+            return await asyncio.to_thread(fetch_search_context, message, thread_id_filter, deadline, request_log)
+
+        async def client_stage(_):
+            await agent_service.initialize_client()
+
+        async def agent_stage(_):
+            return await agent_service.get_agent()
+
+        async def thread_stage(_):
+            await agent_service.create_get_thread()
+
+        async def route_stage(inputs):
+            _, context, _ = inputs["search"]
+            return choose_route(message, context, agent_id)
+
+        async def run_stage(inputs):
+            message_with_context, _, _ = inputs["search"]
+            return await invoke_routed(agent_service, message_with_context, inputs["route"])
+
+        graph = (
+            StageGraph()
+            .add("search", search_stage)
+            .add("client", client_stage)
+            .add("agent", agent_stage, deps=("client",))
+            .add("thread", thread_stage, deps=("client",))
+            .add("route", route_stage, deps=("search",))
+            .add("run", run_stage, deps=("search", "route", "agent", "thread"))
+        )
+        try:
+            results = await graph.run(deadline)
+        finally:
+            if request_log:
+                request_log.set(**graph.summary())
+
+        message_with_context, context, thread_id_filter = results["search"]
+        agent_response, agent_token_usage, session_id = results["run"]
+
         # Construct the chat input
         chat_input = ConversationChatInput(
             channel='Teams',
             user_id=None,  # As per comment in model
-            message=message,
+            message=message_with_context,
             context=context,
             attachments=None,  # As per comment in model
-            datetime=datetime_factory(),
+            datetime=started,
         )
 
-        # Instantiate a new AgentService and invoke the agent
-        agent_service = AgentService(thread_id=thread_id, agent_id=agent_id)
-        agent_response, agent_token_usage, session_id = await agent_service.invoke(message)
-
         if not agent_response:
             raise ValueError("Agent response is empty")
 
@@ -135,11 +266,26 @@ async def function_call_async(
             user_id=None,  # As per comment in model
             request=chat_input,
             response=agent_response,
-            token_usage=agent_token_usage
+            token_usage=agent_token_usage,
+            compaction=agent_service.compaction
         )
 
         assert conversation.response is not None, "Agent response cannot be None"
 
+        if request_log:
+            route = conversation.response.route
+            request_log.set(
+                session_id=session_id,
+                answered_by=conversation.response.agent_id,
+                route=route.question_class if route else None,
+                route_fallback=route.fallback if route else None,
+                prompt_tokens=sum(usage.prompt_tokens or 0 for usage in agent_token_usage),
+                completion_tokens=sum(usage.completion_tokens or 0 for usage in agent_token_usage),
+                retries=conversation.response.retries,
+                response_chars=len(conversation.response.content),
+                compaction=agent_service.compaction.strategy if agent_service.compaction else None,
+            )
+
         # Prepare the response data
         response_data = {
             "message": conversation.response.content,
@@ -149,36 +295,38 @@ async def function_call_async(
         }
 
         # Save the message in the background after response is created
-        async def save_message_background():
+        def save_message_background():
             try:
                 update = Fingerprint(
                     user_id=None,  # As per comment in model
                     datetime=datetime_factory()
                 )
                 conversation.updated = update
+                save_started = time.perf_counter()
                 saved_conversation = conversation.save()
-                logging.info(f"✅ Chat history saved successfully with ID: {saved_conversation.id}")
+                logging.debug(
+                    "✅ Chat history saved successfully with ID: %s in %.0f ms",
+                    saved_conversation.id, (time.perf_counter() - save_started) * 1000
+                )
             except Exception as e:
-                logging.error(f"❌ Error saving chat history to database: {e}")
-
-        # Start the save operation in the background
-        asyncio.create_task(save_message_background())
+                logging.error("❌ Error saving chat history to database: %s", e)
+            try:
+                # Rollups are buffered and flushed by a background thread, see cosmos_utils/usage_rollups.py
+                rollup_buffer.add(conversation)
+            except Exception as e:
+                logging.error("❌ Error updating usage rollups: %s", e)
 
-        # Close the agent service
-        await agent_service.close()
+        # Start the save operation in the background; the Cosmos upsert must not delay the response
+        persistence_executor.submit(save_message_background)
 
         return response_data
 
+    except DeadlineExceeded:
+        raise
     except Exception as e:
-        logging.error(f"Error in function_call_async: {e}")
+        logging.error("Error in function_call_async: %s", e)
         raise Exception(f"Error submit call function: {e}")
-
-# Reduce el nivel de logging de Azure y requests para evitar ruido en consola
-
-
-logging.getLogger('azure').setLevel(logging.WARNING)
-logging.getLogger(
-    'azure.core.pipeline.policies.http_logging_policy'
-).setLevel(logging.WARNING)
-logging.getLogger('azure.storage').setLevel(logging.WARNING)
-logging.getLogger('requests').setLevel(logging.WARNING)
+    finally:
+        # Close the agent service
+        if agent_service:
+            await agent_service.close()
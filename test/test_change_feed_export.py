@@ -0,0 +1,106 @@
+import glob
+import gzip
+import json
+import os
+
+import pytest
+
+from cosmos_utils.change_feed_export import ChangeFeedExporter, InMemoryChangeFeedContainer
+
+
+def chat(item_id, day="2025-01-01", message="hola"):
+    return {
+        "id": item_id,
+        "session_id": f"thread-{item_id}",
+        "request": {"message": message, "context": "tabla grande", "datetime": f"{day}T10:00:00.000000Z"},
+    }
+
+
+def exported(output_dir):
+    """Exported records keyed by id, with every exported version of each record in page order."""
+    records = {}
+    for path in sorted(glob.glob(os.path.join(output_dir, "date=*", "part-*.jsonl.gz")), key=os.path.basename):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                records.setdefault(record["id"], []).append(record)
+    return records
+
+
+def test_resume_after_interruption(tmp_path):
+    container = InMemoryChangeFeedContainer([chat(str(i), day=f"2025-01-0{i % 3 + 1}") for i in range(7)])
+    exporter = ChangeFeedExporter(container, str(tmp_path), page_size=3)
+
+    checkpoint = exporter.run(max_pages=1)
+    assert checkpoint["records"] == 3
+
+    checkpoint = exporter.run()
+    assert checkpoint["records"] == 7
+    records = exported(str(tmp_path))
+    assert sorted(records) == [str(i) for i in range(7)]
+    assert all(len(versions) == 1 for versions in records.values())
+
+
+def test_crash_mid_page_does_not_duplicate(tmp_path, monkeypatch):
+    container = InMemoryChangeFeedContainer([chat(str(i)) for i in range(4)])
+    exporter = ChangeFeedExporter(container, str(tmp_path), page_size=2)
+    exporter.run(max_pages=1)
+
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(exporter, "_save_checkpoint", fail)
+    with pytest.raises(OSError):
+        exporter.run()
+    monkeypatch.undo()
+
+    checkpoint = exporter.run()
+    assert checkpoint["records"] == 4
+    records = exported(str(tmp_path))
+    assert sorted(records) == ["0", "1", "2", "3"]
+    assert all(len(versions) == 1 for versions in records.values())
+
+
+def test_update_after_checkpoint_is_exported(tmp_path):
+    container = InMemoryChangeFeedContainer([chat("a"), chat("b"), chat("c")])
+    exporter = ChangeFeedExporter(container, str(tmp_path))
+    assert exporter.run()["records"] == 3
+
+    container.upsert_item(chat("a", message="editado"))
+    assert exporter.run()["records"] == 4
+
+    container.upsert_item(chat("d"))
+    assert exporter.run()["records"] == 5
+
+    records = exported(str(tmp_path))
+    assert [r["request"]["message"] for r in records["a"]] == ["hola", "editado"]
+    assert "d" in records
+
+
+def test_drop_fields(tmp_path):
+    source = chat("a")
+    container = InMemoryChangeFeedContainer([source])
+    ChangeFeedExporter(container, str(tmp_path), drop_fields=["request.context", "session_id"]).run()
+
+    record = exported(str(tmp_path))["a"][0]
+    assert "context" not in record["request"]
+    assert "session_id" not in record
+    assert "_lsn" not in record
+    assert record["request"]["message"] == "hola"
+    # The source item is left untouched
+    assert source["request"]["context"] == "tabla grande"
+
+
+def test_parquet_export(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    container = InMemoryChangeFeedContainer([chat("a", day="2025-01-01"), chat("b", day="2025-01-02")])
+    checkpoint = ChangeFeedExporter(
+        container, str(tmp_path), export_format="parquet", drop_fields=["request.context"]
+    ).run()
+    assert checkpoint["records"] == 2
+
+    paths = sorted(glob.glob(os.path.join(str(tmp_path), "date=*", "part-*.parquet")))
+    assert [os.path.basename(os.path.dirname(p)) for p in paths] == ["date=2025-01-01", "date=2025-01-02"]
+    rows = [row for path in paths for row in pq.read_table(path).to_pylist()]
+    assert [row["id"] for row in rows] == ["a", "b"]
+    assert "context" not in rows[0]["request"]
@@ -0,0 +1,80 @@
+import asyncio
+import time
+
+import pytest
+
+from agent_services.deadline import Deadline, DeadlineExceeded
+from agent_services.pipeline import StageGraph
+
+
+def sleeper(seconds, value=None):
+    async def stage(inputs):
+        await asyncio.sleep(seconds)
+        return value if value is not None else inputs
+    return stage
+
+
+def test_independent_stages_run_concurrently():
+    graph = StageGraph()
+    graph.add("a", sleeper(0.1, "a")).add("b", sleeper(0.1, "b")).add("c", sleeper(0, None), deps=("a", "b"))
+
+    start = time.perf_counter()
+    results = asyncio.run(graph.run())
+
+    assert time.perf_counter() - start < 0.18
+    assert results["c"] == {"a": "a", "b": "b"}
+
+
+def test_critical_path_follows_slowest_dependency():
+    graph = StageGraph()
+    graph.add("fast", sleeper(0.01, 1)).add("slow", sleeper(0.1, 2)).add("last", sleeper(0.01, 3), deps=("fast", "slow"))
+    asyncio.run(graph.run())
+
+    summary = graph.summary()
+    assert summary["critical_path"] == ["slow", "last"]
+    assert set(summary["stages_ms"]) == {"fast", "slow", "last"}
+    assert "cancelled" not in summary
+
+
+def test_first_failure_is_reported_and_running_stages_cancelled():
+    async def broken(inputs):
+        await asyncio.sleep(0.01)
+        raise ValueError("search down")
+
+    graph = StageGraph()
+    graph.add("search", broken).add("client", sleeper(1, "client")).add("run", sleeper(0, None), deps=("search", "client"))
+
+    with pytest.raises(ValueError, match="search down"):
+        asyncio.run(graph.run())
+
+    assert set(graph.timings) == {"search"}
+    assert graph.cancelled == ["client"]
+
+
+def test_deadline_names_only_started_stages():
+    graph = StageGraph()
+    graph.add("a", sleeper(0, 1)).add("b", sleeper(1, 2), deps=("a",)).add("c", sleeper(0, 3), deps=("b",))
+
+    with pytest.raises(DeadlineExceeded) as exc:
+        asyncio.run(graph.run(Deadline(0.05)))
+
+    assert exc.value.stage == "b"
+    assert set(graph.timings) == {"a"}
+    assert graph.cancelled == ["b"]
+    summary = graph.summary()
+    assert summary["critical_path"] == ["a"]
+    assert summary["cancelled"] == ["b"]
+
+
+def test_stage_after_deadline_does_not_start():
+    ran = []
+
+    async def late(inputs):
+        ran.append(True)
+
+    graph = StageGraph()
+    graph.add("a", sleeper(0.06, 1)).add("b", late, deps=("a",))
+
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(graph.run(Deadline(0.05)))
+    assert not ran
@@ -0,0 +1,120 @@
+import threading
+import time
+
+import pytest
+
+from agent_services.single_flight import KeyedLocks, LockTimeout, SingleFlight, request_key
+
+
+def test_request_key_skips_new_conversations():
+    assert request_key(None, "asst", "hola") is None
+    assert request_key("thread", "asst", "hola") == request_key("thread", "asst", "hola")
+    assert request_key("thread", "asst", "hola") != request_key("thread", "asst", "adios")
+
+
+def test_duplicate_waits_for_leader_result():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "respuesta"
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do("k", slow)))
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=lambda: results.append(flight.do("k", slow)))
+    follower.start()
+    time.sleep(0.05)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert len(calls) == 1
+    assert sorted(results, key=lambda r: r[1]) == [("respuesta", False), ("respuesta", True)]
+
+
+def test_leader_failure_reaches_duplicates_and_is_not_cached():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def failing():
+        started.set()
+        release.wait(5)
+        raise RuntimeError("foundry down")
+
+    errors = []
+
+    def call():
+        try:
+            flight.do("k", failing)
+        except RuntimeError as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=call)
+    follower.start()
+    time.sleep(0.05)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert [str(e) for e in errors] == ["foundry down", "foundry down"]
+    # The next delivery runs again instead of getting the failure
+    assert flight.do("k", lambda: "ok") == ("ok", False)
+
+
+def test_cached_result_expires_after_window():
+    flight = SingleFlight(window_seconds=0.05)
+    assert flight.do("k", lambda: 1) == (1, False)
+    assert flight.do("k", lambda: 2) == (1, True)
+    time.sleep(0.1)
+    assert flight.do("k", lambda: 3) == (3, False)
+
+
+def test_eviction_respects_max_entries():
+    flight = SingleFlight(max_entries=2)
+    flight.do("a", lambda: "a")
+    flight.do("b", lambda: "b")
+    # Reading "a" makes "b" the oldest entry
+    assert flight.do("a", lambda: "new") == ("a", True)
+    flight.do("c", lambda: "c")
+
+    assert flight.do("b", lambda: "new") == ("new", False)
+    assert flight.do("c", lambda: "new") == ("c", True)
+
+
+def test_lock_times_out_while_held():
+    locks = KeyedLocks()
+    held = threading.Event()
+    release = threading.Event()
+
+    def holder():
+        with locks.hold("thread"):
+            held.set()
+            release.wait(5)
+
+    t = threading.Thread(target=holder)
+    t.start()
+    held.wait(5)
+    try:
+        with pytest.raises(LockTimeout):
+            with locks.hold("thread", timeout=0.05):
+                pass
+        # Other keys are not blocked
+        with locks.hold("other", timeout=0.05):
+            pass
+    finally:
+        release.set()
+        t.join(5)
+
+    with locks.hold("thread", timeout=0.05):
+        pass